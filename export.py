@@ -0,0 +1,252 @@
+import os
+import platform
+import time
+from typing import Optional
+
+import cv2
+import torch
+from ultralytics import YOLO  # type: ignore
+
+import util
+
+# Input size the engine is built for; model.track must use the same value
+IMG_SIZE = 640
+
+# INT8 calibration data, captured from the same cameras used in flight
+CALIB_FOLDER = os.path.abspath("calib")
+CALIB_YAML = os.path.abspath("calib.yaml")
+NUM_CALIB_FRAMES = 300
+# A camera that fails this many reads in a row (~5 s) is dropped from calibration
+MAX_FAILED_READS = 25
+
+
+def engine_path(model_path: str) -> str:
+    """Return the path of the TensorRT engine cached next to `model_path`."""
+    return os.path.splitext(model_path)[0] + ".engine"
+
+
+def is_arm() -> bool:
+    """Return True on ARM hosts (Raspberry Pi, Jetson CPU fallback)."""
+    return platform.machine().lower() in ("aarch64", "arm64", "armv7l")
+
+
+def cpu_model_path(model_path: str, batch: int = 1) -> Optional[str]:
+    """Return the path of the CPU-optimized export cached next to `model_path`.
+
+    This is an OpenVINO model on x86 and an NCNN model on ARM. Ultralytics only
+    runs NCNN models one image at a time, so returns None on ARM when `batch` > 1.
+    """
+    if is_arm():
+        if batch > 1:
+            return None
+        return os.path.splitext(model_path)[0] + "_ncnn_model"
+    return os.path.splitext(model_path)[0] + "_openvino_model"
+
+
+def _mtime(path: str) -> float:
+    """Return the modification time of `path`, or of the newest entry in it if it is a directory."""
+    mtime = os.path.getmtime(path)
+    if os.path.isdir(path):
+        with os.scandir(path) as it:
+            for entry in it:
+                mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+def is_stale(exported: str, model_path: str) -> bool:
+    """Return True if the export at `exported` is older than the weights at `model_path`."""
+    return os.path.exists(model_path) and _mtime(exported) < os.path.getmtime(model_path)
+
+
+def failed_marker_path(exported: str) -> str:
+    """Return the path of the marker left next to `exported` while exporting it has not succeeded."""
+    return exported + ".failed"
+
+
+def _write_marker(marker: str, text: str) -> None:
+    try:
+        with open(marker, "w") as f:
+            f.write(text + "\n")
+    except OSError as e:
+        print(f"Failed to write {marker}: {e}")
+
+
+def _remove_marker(marker: str) -> None:
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def capture_calibration_frames(cameras: list[int], model_path: str, count: int = NUM_CALIB_FRAMES) -> bool:
+    """Save `count` frames from `cameras` for INT8 calibration and write the dataset yaml.
+
+    Frames are taken round-robin from every camera that opens, a few per second,
+    in the same capture mode and size the tracker uses, so the calibration set
+    covers the same scenes and frames the model sees in flight. Cameras that
+    stop returning frames are dropped. Returns False if no frame could be captured.
+    """
+    image_dir = os.path.join(CALIB_FOLDER, "images")
+    os.makedirs(image_dir, exist_ok=True)
+
+    videos: list[cv2.VideoCapture] = []
+    opened: list[int] = []  # camera index of each entry in videos
+    for c in cameras:
+        video = cv2.VideoCapture(c)
+        if video.isOpened():
+            util.configure_camera(video)
+            videos.append(video)
+            opened.append(c)
+        else:
+            video.release()
+
+    if len(videos) == 0:
+        print("No cameras available for calibration")
+        return False
+
+    i = 0
+    failed_reads: list[int] = [0] * len(videos)
+    try:
+        while i < count and any(n < MAX_FAILED_READS for n in failed_reads):
+            for v, video in enumerate(videos):
+                if i >= count or failed_reads[v] >= MAX_FAILED_READS:
+                    continue
+                ret, frame = video.read()
+                if not ret or frame is None:
+                    failed_reads[v] += 1
+                    if failed_reads[v] == MAX_FAILED_READS:
+                        print(f"Camera {opened[v]} stopped returning frames; skipping it")
+                    continue
+                failed_reads[v] = 0
+                if (frame.shape[1], frame.shape[0]) != util.FRAME_SIZE:
+                    frame = cv2.resize(frame, util.FRAME_SIZE, interpolation=cv2.INTER_LINEAR)
+                cv2.imwrite(os.path.join(image_dir, f"calib{i}.jpg"), frame)
+                i += 1
+            time.sleep(0.2)
+    finally:
+        for video in videos:
+            video.release()
+
+    if i == 0:
+        print("No calibration frames captured")
+        return False
+
+    # Calibration only needs images, but the dataset yaml must list the model's classes
+    names = YOLO(model_path).names
+    with open(CALIB_YAML, "w") as f:
+        f.write(f"path: {CALIB_FOLDER}\n")
+        f.write("train: images\n")
+        f.write("val: images\n")
+        f.write("names:\n")
+        for cls_id, name in names.items():
+            f.write(f"  {cls_id}: {name}\n")
+
+    print(f"Saved {i} calibration frames to {image_dir}")
+    return True
+
+
+def export_engine(model_path: str, batch: int = 1) -> str:
+    """Export `model_path` to a TensorRT engine and return the engine path.
+
+    Uses INT8 when calibration data has been captured, FP16 otherwise. The engine
+    accepts any batch size up to `batch`, so one call can cover every camera.
+    """
+    model = YOLO(model_path)
+    if os.path.exists(CALIB_YAML):
+        return model.export(
+            format="engine",
+            half=False,
+            int8=True,
+            data=CALIB_YAML,
+            imgsz=IMG_SIZE,
+            dynamic=True,
+            batch=batch,
+            simplify=True,
+            workspace=4,
+        )
+    print("No calibration data found; exporting FP16 engine")
+    return model.export(format="engine", half=True, imgsz=IMG_SIZE, dynamic=True, batch=batch, simplify=True)
+
+
+def export_cpu_model(model_path: str, batch: int = 1) -> str:
+    """Export `model_path` for CPU inference and return the exported model path.
+
+    x86 hosts get an OpenVINO model (INT8 when calibration data has been captured),
+    ARM hosts get an NCNN model.
+    """
+    model = YOLO(model_path)
+    if is_arm():
+        return model.export(format="ncnn", imgsz=IMG_SIZE)
+    if os.path.exists(CALIB_YAML):
+        return model.export(format="openvino", int8=True, data=CALIB_YAML, imgsz=IMG_SIZE, dynamic=True, batch=batch)
+    print("No calibration data found; exporting FP32 OpenVINO model")
+    return model.export(format="openvino", imgsz=IMG_SIZE, dynamic=True, batch=batch)
+
+
+def load_pytorch_model(model_path: str) -> YOLO:
+    """Load the PyTorch weights at `model_path` with Conv+BN fused, ready for inference."""
+    model = YOLO(model_path)
+    model.fuse()
+    model.model.eval()
+    return model
+
+
+def load_model(model_path: str, batch: int = 1) -> YOLO:
+    """Load the fastest export of `model_path` for this host, exporting one first if needed.
+
+    CUDA hosts use a TensorRT engine and CPU-only hosts use OpenVINO or NCNN.
+    An export older than `model_path` (e.g. after retraining) is rebuilt. A failed
+    export leaves a marker next to it so later starts skip straight to the fallback
+    until `python export.py` succeeds or `model_path` changes.
+    Falls back to the PyTorch weights when no up-to-date export is available or it fails.
+    """
+    if torch.cuda.is_available():
+        exported = engine_path(model_path)
+        exporter = export_engine
+    else:
+        exported = cpu_model_path(model_path, batch)
+        exporter = export_cpu_model
+    if exported is None:
+        return load_pytorch_model(model_path)
+
+    stale = os.path.exists(exported) and is_stale(exported, model_path)
+    marker = failed_marker_path(exported)
+    if stale or not os.path.exists(exported):
+        if os.path.exists(marker) and not is_stale(marker, model_path):
+            # Don't retry a failed (possibly minutes-long) export on every start
+            print(f"Skipping export of {model_path}, it failed before (see {marker}); run `python export.py` to retry")
+        else:
+            if stale:
+                print(f"{exported} is older than {model_path}; re-exporting")
+            # Written first so an export that crashes or is killed also counts as failed
+            _write_marker(marker, f"export of {model_path} started at {time.ctime()} did not finish")
+            try:
+                exported = exporter(model_path, batch)
+                _remove_marker(marker)
+            except Exception as e:
+                print(f"Failed to export {model_path}: {e}")
+                _write_marker(marker, f"export of {model_path} failed at {time.ctime()}: {e}")
+    # Never run an export of older weights, even if re-exporting failed
+    if os.path.exists(exported) and not is_stale(exported, model_path):
+        print(f"Loading exported model {exported}")
+        return YOLO(exported, task="detect")
+    return load_pytorch_model(model_path)
+
+
+if __name__ == "__main__":
+    MODEL_PATH = "models/mannequinmodel.pt"
+    BATCH = 5  # one frame per camera in main.py
+    if torch.cuda.is_available():
+        cached = engine_path(MODEL_PATH)
+        exporter = export_engine
+    else:
+        cached = cpu_model_path(MODEL_PATH, BATCH)
+        exporter = export_cpu_model
+
+    if cached is None:
+        # load_model would never use an NCNN model with this many cameras
+        print(f"NCNN models run one image at a time, so main.py uses {MODEL_PATH} for {BATCH} cameras; nothing to export")
+    else:
+        # Without calibration frames this still produces an FP16 engine / FP32 OpenVINO model
+        capture_calibration_frames([i for i in range(BATCH)], MODEL_PATH)
+        print(f"Exported {exporter(MODEL_PATH, batch=BATCH)}")
+        # Lets load_model use the export again after an earlier failure
+        _remove_marker(failed_marker_path(cached))
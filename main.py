@@ -2,18 +2,21 @@
 
 #! ./venv/bin/python3
 import functools
+import logging
 import os
 import platform
 import signal
 import subprocess
 import sys
 import time
-from threading import Thread
-from queue import Empty, Full, Queue
+from threading import Event, Thread
+from queue import Empty, Queue
 import shutil
+from typing import Optional
 
 import cv2
 import numpy as np
+import torch
 from mjpeg_streamer import MjpegServer, Stream
 from ultralytics import YOLO  # type: ignore
 from ultralytics.engine.results import Results  # type: ignore
@@ -21,11 +24,20 @@ from ultralytics.engine.results import Results  # type: ignore
 import telemetry
 import util
 import mapping
+import export
 import time
 
 # Model path
 MODEL_PATH = "models/mannequinmodel.pt"
 
+# Let any FP32 matmuls left outside the engine use TF32 tensor cores
+torch.set_float32_matmul_precision("high")
+# Input shapes are fixed, so let cuDNN benchmark and keep the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
+
+# Frames are resized to this (width, height) so the whole batch shares one letterbox
+FRAME_SIZE = util.FRAME_SIZE
+
 # Define camera indexes to display in separate windows
 # Reverted to a fixed set to ensure all potential feeds create windows
 cameras = [i for i in range(5)]
@@ -48,9 +60,17 @@ SKIP_MACOS_AUTH: bool = bool(int(os.getenv("SOMARS_SKIP_MACOS_AUTH", "0")))
 if platform.system() == "Darwin" and SKIP_MACOS_AUTH:
     os.environ["OPENCV_AVFOUNDATION_SKIP_AUTH"] = "1"
 
+# Per-frame debug output (batch contents, target offsets); set SOMARS_DEBUG=1 to enable
+logging.basicConfig(format="%(message)s")
+logger: logging.Logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if bool(int(os.getenv("SOMARS_DEBUG", "0"))) else logging.INFO)
+
 # exit gracefully on ^C
 is_interrupted: bool = False
 
+# set by camera threads whenever a new frame is queued for the tracker
+frame_ready: Event = Event()
+
 @functools.cache # only run once
 def get_ips() -> list[str]:
     ip_list: list[str] = []
@@ -68,8 +88,8 @@ def handle_signal(signalnum, stack_frame):
 # handle SIGTERM nicely
 signal.signal(signal.SIGTERM, handle_signal)
 
-# Load the model
-model = YOLO(MODEL_PATH)
+# Load the model (the TensorRT or OpenVINO/NCNN export for this host if available)
+model: YOLO = export.load_model(MODEL_PATH, batch=len(cameras))
 
 image_folder = os.path.abspath("images")
 output_folder = os.path.abspath("output")
@@ -87,18 +107,22 @@ print("Program started")
 
 def run_cam_in_thread(cameraname, q: Queue) -> None:
     video: cv2.VideoCapture = cv2.VideoCapture(cameraname)  # Read the video file
+    # Strings are video files, anything else is a camera index; decided once rather than per frame
+    is_file: bool = isinstance(cameraname, str)
+    if not is_file:
+        util.configure_camera(video)
 
     store_q: Queue = Queue(maxsize=1)
     store_thread = Thread(target=store_images_in_thread, args=[store_q], daemon=False)
     store_thread.start()
 
     while True:
-        if type(cameraname) == str:
+        if is_file:
             time.sleep(1/30)
         ret: bool
         frame: np.ndarray
         ret, frame = video.read()  # Read the video frames
-        start_time: float = time.time()
+        start_time: float = time.monotonic()
 
         # exit if no frames remain
         if not ret:
@@ -110,40 +134,20 @@ def run_cam_in_thread(cameraname, q: Queue) -> None:
         if frame is None:
             continue
 
-        # Empty the queue if it is full so the frame in it is the most recent one
-        if q.full():
-            # This should almost never happen, but it avoids any potential errors if it is emptied between calling full and get
-            try:
-                q.get_nowait()
-            except Empty:
-                pass
-        try:
-            q.put_nowait((frame.copy(), start_time))
-        except Full:
-            pass
-    
-        # Empty the queue if it is full so the frame in it is the most recent one
-        if store_q.full():
-            # This should almost never happen, but it avoids any potential errors if it is emptied between calling full and get
-            try:
-                store_q.get_nowait()
-            except Empty:
-                pass
-        try:
-            store_q.put_nowait(frame.copy())
-        except Full:
-            pass
+        # Resize here so it overlaps with inference on the tracker thread (cv2 releases the GIL).
+        # Stored images keep the full resolution for mapping.
+        small: np.ndarray = frame
+        if (frame.shape[1], frame.shape[0]) != FRAME_SIZE:
+            small = cv2.resize(frame, FRAME_SIZE, interpolation=cv2.INTER_LINEAR)
 
-    if store_q.full():
-        # This should almost never happen, but it avoids any potential errors if it is emptied between calling full and get
-        try:
-            store_q.get_nowait()
-        except Empty:
-            pass
-    try:
-        store_q.put_nowait(None)
-    except Exception:
-        pass
+        # read() allocates a new buffer every call and consumers never write to it,
+        # so frames can be queued without copying.
+        # Replace whatever is queued so the consumers always get the most recent frame
+        util.put_latest(q, (small, start_time))
+        frame_ready.set()
+        util.put_latest(store_q, frame)
+
+    util.put_latest(store_q, None)
     store_thread.join()
     print(f"CAMERA {cameraname} EXITING (camera thread)")
     # Release video sources
@@ -173,81 +177,159 @@ def store_images_in_thread(store_q: Queue) -> None:
         elif signal != "picture":
             picture_taken = False
 
-def run_tracker_in_thread(cameraname, stream: Stream, out_q: Queue) -> None:
+# A viewer counts as gone after this many frame intervals without pulling a frame
+VIEWER_TIMEOUT_FRAMES = 3
+
+class DetectorStream(Stream):
+    """MJPEG stream that only takes new frames while someone is watching, at most `fps` times a second."""
+
+    def __init__(self, name: str, size: Optional[tuple[int, int]] = None, quality: int = 50, fps: int = 30) -> None:
+        super().__init__(name, size=size, quality=quality, fps=fps)
+        self._frame_interval: float = 1.0 / fps
+        self._next_frame_time: float = 0.0
+        # time.monotonic() of the last frame a viewer pulled, updated from the server's event loop
+        self._last_pull_time: float = float("-inf")
+        # Camera whose frame was published last; cameras take turns on the shared stream
+        self._last_camera: int = -1
+
+    async def get_frame_processed(self) -> np.ndarray:
+        # mjpeg_streamer calls this once per frame it sends to each connected viewer
+        self._last_pull_time = time.monotonic()
+        return await super().get_frame_processed()
+
+    def has_clients(self) -> bool:
+        """Return True if a viewer has pulled a frame within the last few frame intervals."""
+        return time.monotonic() - self._last_pull_time < VIEWER_TIMEOUT_FRAMES * self._frame_interval
+
+    def wants_frame(self) -> bool:
+        """Return True if a frame set now would be sent to a viewer."""
+        return time.monotonic() >= self._next_frame_time and self.has_clients()
+
+    def next_camera(self, cameras: list[int]) -> Optional[int]:
+        """Return which of `cameras` to publish now, rotating through them, or None if no frame is wanted."""
+        if len(cameras) == 0 or not self.wants_frame():
+            return None
+        later: list[int] = [c for c in cameras if c > self._last_camera]
+        self._last_camera = min(later) if later else min(cameras)
+        return self._last_camera
+
+    def set_frame(self, frame: np.ndarray) -> None:
+        self._next_frame_time = time.monotonic() + self._frame_interval
+        super().set_frame(frame)
+
+@functools.cache # one template per frame shape
+def get_hud_template(shape: tuple[int, ...]) -> np.ndarray:
+    """Return a black image of `shape` with the crosshair drawn at its center."""
+    hud: np.ndarray = np.zeros(shape, dtype=np.uint8)
+    center: tuple[int, int] = (shape[1] // 2, shape[0] // 2)
+    size: int = 50
+    cv2.line(hud, (center[0] - size, center[1]), (center[0] + size, center[1]), (0, 128, 255), 5)
+    cv2.line(hud, (center[0], center[1] - size), (center[0], center[1] + size), (0, 128, 255), 5)
+    return hud
+
+def run_tracker_in_thread(cam_queues: dict[int, Queue], cam_threads: list[Thread], stream: DetectorStream, out_q: Queue) -> None:
     """
-    Runs a video file or webcam stream concurrently with the YOLOv8 model using threading.
+    Runs the YOLOv8 model on the latest frame from every camera in a single batched call.
 
-    This function captures video frames from a given file or camera source and utilizes the YOLOv8 model for object
-    tracking. The function runs in its own thread for concurrent processing.
+    Camera threads push frames into `cam_queues`; each pass takes whatever frames are waiting, tracks them in one
+    `model.predict` call, then tracks each camera's detections with that camera's own tracker and sends each result
+    to the display queue tagged with its camera index. Batching amortizes kernel launches across cameras instead of
+    running one forward pass per camera.
 
     Args:
-        cameraname (int): The identifier for the webcam/external camera source.
+        cam_queues (dict[int, Queue]): Latest (frame, start_time) from each camera, keyed by camera index.
+        cam_threads (list[Thread]): The camera threads; the tracker exits once they have all finished.
+        stream (DetectorStream): The MJPEG stream to publish annotated frames to, or None.
+        out_q (Queue): (camera index, frame) pairs read by the main-thread display loop.
 
     Note:
         Press 'q' to quit the video display window.
     """
 
-    q: Queue = Queue(maxsize=1)
-    cam_thread = Thread(target=run_cam_in_thread, args=(cameraname, q), daemon=False)
-    cam_thread.start()
-
-    global is_interrupted
+    print("Tracker activating")
 
-    print(f"Camera {cameraname} activating")
+    # Smoothed FPS per camera and the text drawn for it, refreshed once per second
+    fps_ema: dict[int, float] = {c: 0.0 for c in cam_queues}
+    fps_text: dict[int, str] = {c: "0.0" for c in cam_queues}
+    fps_second: int = 0
+    # One tracker per camera, so track IDs never match boxes across different cameras' views
+    trackers: dict[int, object] = {c: util.make_tracker() for c in cam_queues}
 
-    # Exit the loop if no more frames in the video
-    while not is_interrupted and cam_thread.is_alive():
-        if (is_interactive):
-            print(f"Camera: {cameraname}") # For debugging 
-
-        try:
-            start_time: float
-            frame: np.ndarray
-            frame, start_time = q.get(block=True, timeout=5)
-        except Empty: # stop the thread getting stuck if the camera thread immidiately dies
+    # Exit the loop once every camera has run out of frames
+    while not is_interrupted and any(t.is_alive() for t in cam_threads):
+        # Wait for at least one camera to produce a frame
+        if not frame_ready.wait(timeout=5):
             continue
+        frame_ready.clear()
 
-        # Track objects in frames if available
-        results: list[Results] = model.track(frame, persist=True, verbose=is_interactive)
-        res_plotted: np.ndarray = results[0].plot()
-        # Calculate offsets
-        telemetry.add_results(results, start_time)
-        end_time: float = time.time()
-
-        if results[0] is not None and len(results[0].boxes) != 0 and len(results[0].boxes[0]) is not None:
-            print("x: " + str(util.get_x_offset_deg(results[0].boxes)))
-            print("y: " + str(util.get_y_offset_deg(results[0].boxes)))
-
-        # Overlay HUD and stream via MJPEG
-        elapsed = end_time - start_time
-        fps: float = round(1 / elapsed, 2) if elapsed > 1e-6 else 0.0
-        center: tuple[int, int] = (res_plotted.shape[1] // 2, res_plotted.shape[0] // 2)
-        size: int = 50
-        cv2.line(res_plotted, (center[0] - size, center[1]), (center[0] + size, center[1]), (0, 128, 255), 5)
-        cv2.line(res_plotted, (center[0], center[1] - size), (center[0], center[1] + size), (0, 128, 255), 5)
-        cv2.putText(res_plotted, str(fps), (7, 70), cv2.FONT_HERSHEY_SIMPLEX, 3, (100, 255, 0), 3, cv2.LINE_AA)
-
-        if enable_mjpeg and stream is not None:
-            stream.set_frame(res_plotted)
-
-        # Send frame to main-thread display queue
-        if enable_display:
-            if out_q.full():
-                try:
-                    out_q.get_nowait()
-                except Empty:
-                    pass
+        batch_cams: list[int] = []
+        frames: list[np.ndarray] = []
+        start_times: list[float] = []
+        for c, q in cam_queues.items():
             try:
-                out_q.put_nowait(res_plotted)
-            except Full:
-                pass
+                frame, start_time = q.get_nowait()
+            except Empty:
+                continue
+            batch_cams.append(c)
+            frames.append(frame)
+            start_times.append(start_time)
+
+        if len(frames) == 0:
+            continue
 
-    cam_thread.join()
-    print(f"CAMERA {cameraname} EXITING (detector thread)")
+        # Checking the level first skips building the message when debug output is off
+        debug: bool = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Cameras: %s", batch_cams)
+
+        # Detect objects in all frames at once; ultralytics treats a list of arrays as one batch.
+        # model.track would run every frame in the list through a single tracker, so each
+        # camera's detections are tracked separately instead.
+        with torch.inference_mode():
+            results: list[Results] = model.predict(frames, imgsz=export.IMG_SIZE, half=True, verbose=False)
+        results = [util.update_tracker(trackers[c], result) for c, result in zip(batch_cams, results)]
+        # Calculate offsets, timing latency from the oldest frame in the batch
+        telemetry.add_results(results, min(start_times))
+        end_time: float = time.monotonic()
+        refresh_fps: bool = int(end_time) != fps_second
+        fps_second = int(end_time)
+
+        # At most one camera per stream interval, taking turns so every camera gets shown
+        stream_cam: Optional[int] = stream.next_camera(batch_cams) if enable_mjpeg and stream is not None else None
+
+        for c, result, start_time in zip(batch_cams, results, start_times):
+            if debug and result is not None and len(result.boxes) != 0:
+                logger.debug("x: %s", util.get_x_offset_deg(result.boxes))
+                logger.debug("y: %s", util.get_y_offset_deg(result.boxes))
+
+            # Rendering is only needed when frames are displayed or streamed to a viewer
+            send_to_stream: bool = c == stream_cam
+            if not (send_to_stream or enable_display):
+                continue
+            # Keep plotting on the OpenCV path; PIL text rendering is far slower
+            res_plotted: np.ndarray = result.plot(pil=False, line_width=2)
+
+            # Overlay HUD and stream via MJPEG
+            elapsed = end_time - start_time
+            if elapsed > 1e-6:
+                fps_ema[c] = 0.9 * fps_ema[c] + 0.1 / elapsed
+            if refresh_fps:
+                fps_text[c] = str(round(fps_ema[c], 2))
+            cv2.add(res_plotted, get_hud_template(res_plotted.shape), dst=res_plotted)
+            cv2.putText(res_plotted, fps_text[c], (7, 70), cv2.FONT_HERSHEY_SIMPLEX, 3, (100, 255, 0), 3, cv2.LINE_AA)
+
+            if send_to_stream:
+                stream.set_frame(res_plotted)
+
+            # Send frame to main-thread display queue
+            if enable_display:
+                util.put_latest(out_q, (c, res_plotted))
+
+    print("TRACKER EXITING (detector thread)")
 
 
 if (enable_mjpeg):
-    stream: Stream = Stream("Detectorator", size=(640, 480), quality=50, fps=10)
+    stream: DetectorStream = DetectorStream("Detectorator", size=(640, 480), quality=50, fps=10)
     server: MjpegServer = MjpegServer("0.0.0.0", 5090)
     server.add_stream(stream)
     server.start()
@@ -267,18 +349,24 @@ if platform.system() == "Darwin" and not SKIP_MACOS_AUTH:
             pass
         cap.release()
 
-# Per-camera queues for main-thread display
-display_queues: dict[int, Queue] = {c: Queue(maxsize=1) for c in cameras}
+# (camera index, frame) pairs for main-thread display, shared by every camera
+display_queue: Queue = Queue(maxsize=len(cameras))
+# Per-camera queues feeding the tracker
+frame_queues: dict[int, Queue] = {c: Queue(maxsize=1) for c in cameras}
 
 for c in cameras:
     # Create the thread
-    # daemon=True makes it shut down if something goes wrong
-    thread = Thread(target=run_tracker_in_thread, args=(c, stream, display_queues[c]), daemon=True)
+    thread = Thread(target=run_cam_in_thread, args=(c, frame_queues[c]), daemon=False)
     # Add to the array to use later
     threads.append(thread)
     # Start the thread
     thread.start()
 
+# A single tracker thread runs inference for every camera
+# daemon=True makes it shut down if something goes wrong
+tracker_thread: Thread = Thread(target=run_tracker_in_thread, args=(frame_queues, threads, stream, display_queue), daemon=True)
+tracker_thread.start()
+
 mapping_init_thread: Thread = Thread(target=mapping.initialize, daemon=True)
 mapping_init_thread.start()
 
@@ -291,18 +379,19 @@ try:
             cv2.resizeWindow(window_name, 960, 540)
 
         while True:
-            # Show latest frames if available
-            for c in cameras:
-                window_name = f"Camera {c}"
+            # Take everything queued since the last refresh, keeping only the newest frame per camera
+            latest: dict[int, np.ndarray] = {}
+            while True:
                 try:
-                    frame = display_queues[c].get_nowait()
+                    c, frame = display_queue.get_nowait()
                 except Empty:
-                    frame = None
-                if frame is not None:
-                    cv2.imshow(window_name, frame)
+                    break
+                latest[c] = frame
+            for c, frame in latest.items():
+                cv2.imshow(f"Camera {c}", frame)
 
-            # Handle key events
-            key = cv2.waitKey(1) & 0xFF
+            # Handle key events; waiting 16 ms paces the loop to a ~60 Hz display refresh
+            key = cv2.waitKey(16) & 0xFF
             if key == ord('q') or key == 27:
                 print("Quit requested from window")
                 is_interrupted = True
@@ -312,19 +401,20 @@ try:
             # Also break if all threads have exited
             if all(not t.is_alive() for t in threads):
                 break
-
-            time.sleep(0.001)
     else:
-        while True:
-            time.sleep(1)
+        # Headless: no window events to pump, so just wait for the tracker to finish.
+        # The timeout lets ^C / SIGTERM interrupt the wait.
+        while tracker_thread.is_alive():
+            tracker_thread.join(timeout=1)
 except (KeyboardInterrupt, SystemExit) as e:
     print(COLOR_BOLD, "INTERRUPT RECIEVED -- EXITING", COLOR_RESET, sep="")
     is_interrupted = True
     mapping.stop_event.set()
 
-# Wait for the tracker threads to finish
+# Wait for the camera and tracker threads to finish
 for thread in threads:
     thread.join()
+tracker_thread.join()
 
 if (enable_mjpeg):
     # Clean up
@@ -1,3 +1,4 @@
+import functools
 import http.client
 import json
 import os
@@ -15,10 +16,15 @@ from pyodm import Node
 
 FILE_NAME = "UCSC_SOMARS_map.png"
 
+# How long a `docker ps` result is reused before asking docker again
+CONTAINER_CACHE_TTL = 5.0
+
 node: Node = None
 initialized: bool = False
 lock: threading.Lock = threading.Lock()
 stop_event: threading.Event = threading.Event()
+# container name -> (time.monotonic() of the check, `docker ps` output)
+_container_cache: dict[str, tuple[float, str]] = {}
 
 def _run_cmd(cmd: list[str]) -> tuple[int, str, str]:
     """Run a command and return (returncode, stdout, stderr)."""
@@ -30,6 +36,28 @@ def _run_cmd(cmd: list[str]) -> tuple[int, str, str]:
         return -1, "", str(e)
 
 
+@functools.lru_cache(maxsize=None)
+def _docker_available() -> bool:
+    """Return True if the docker CLI runs. Cached since this can't change at runtime."""
+    rc, _, _ = _run_cmd(["docker", "--version"])
+    return rc == 0
+
+
+def _container_status(name: str) -> Optional[str]:
+    """Return `docker ps` output for containers matching `name`, or None on failure.
+
+    Results are reused for CONTAINER_CACHE_TTL seconds.
+    """
+    cached = _container_cache.get(name)
+    if cached is not None and time.monotonic() - cached[0] < CONTAINER_CACHE_TTL:
+        return cached[1]
+    rc, out, _ = _run_cmd(["docker", "ps", "-a", "--filter", f"name={name}", "--format", "{{.Names}} {{.Status}}"])
+    if rc != 0:
+        return None
+    _container_cache[name] = (time.monotonic(), out)
+    return out
+
+
 def ensure_nodeodm_container(name: str = "nodeodm", image: str = "opendronemap/nodeodm:latest", port: int = 3000) -> bool:
     """Ensure a Docker container running NodeODM is available locally.
 
@@ -37,14 +65,13 @@ def ensure_nodeodm_container(name: str = "nodeodm", image: str = "opendronemap/n
     If Docker is not installed or the container cannot be started, returns False.
     """
     # Check docker exists
-    rc, _, _ = _run_cmd(["docker", "--version"])
-    if rc != 0:
+    if not _docker_available():
         print("Docker CLI not found or not runnable. Install Docker or ensure 'docker' is on PATH.")
         return False
 
     # Check if container exists
-    rc, out, _ = _run_cmd(["docker", "ps", "-a", "--filter", f"name={name}", "--format", "{{.Names}} {{.Status}}"])
-    if rc != 0:
+    out = _container_status(name)
+    if out is None:
         print("Failed to list docker containers")
         return False
 
@@ -55,6 +82,7 @@ def ensure_nodeodm_container(name: str = "nodeodm", image: str = "opendronemap/n
         else:
             # start container
             print(f"Starting existing container '{name}'...")
+            _container_cache.pop(name, None)
             rc, _, err = _run_cmd(["docker", "start", name])
             if rc != 0:
                 print(f"Failed to start container {name}: {err}")
@@ -62,6 +90,7 @@ def ensure_nodeodm_container(name: str = "nodeodm", image: str = "opendronemap/n
     else:
         # Pull image and run container
         print(f"Creating and starting container '{name}' from image {image}...")
+        _container_cache.pop(name, None)
         rc, _, err = _run_cmd(["docker", "pull", image])
         if rc != 0:
             print(f"Failed to pull image {image}: {err}")
@@ -82,21 +111,29 @@ def ensure_nodeodm_container(name: str = "nodeodm", image: str = "opendronemap/n
             print(f"Failed to run container {name}: {err}")
             return False
 
-    # Wait for HTTP endpoint
+    # Wait for HTTP endpoint, backing off from 0.1s to 2s between attempts
     deadline = time.time() + 600.0
-    while time.time() < deadline:
-        try:
-            conn = http.client.HTTPConnection("localhost", port, timeout=2)
-            conn.request("GET", "/")
-            resp = conn.getresponse()
-            # any response means the server is up
-            print("NodeODM responded")
-            return True
-        except (ConnectionRefusedError, socket.timeout, OSError):
-            time.sleep(1.0)
-        except Exception as e:
-            print(f"HTTP check error: {e}")
-            time.sleep(1.0)
+    delay = 0.1
+    # HTTPConnection reopens the socket on the next request after close()
+    conn = http.client.HTTPConnection("localhost", port, timeout=2)
+    try:
+        while time.time() < deadline:
+            try:
+                # HEAD so the index page body isn't transferred on every attempt
+                conn.request("HEAD", "/")
+                conn.getresponse()
+                # any response means the server is up
+                print("NodeODM responded")
+                return True
+            except (ConnectionRefusedError, socket.timeout, OSError):
+                conn.close()
+            except Exception as e:
+                print(f"HTTP check error: {e}")
+                conn.close()
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+    finally:
+        conn.close()
 
     print("Timed out waiting for NodeODM to become available on localhost:%d" % port)
     return False
@@ -227,11 +264,9 @@ def generate_map():
             print("Could not find images folder")
             return
 
-        image_paths: list[str] = []
-        for name in os.listdir(image_folder):
-            full = os.path.join(image_folder, name)
-            if os.path.isfile(full):
-                image_paths.append(full)
+        # scandir entries cache their file type, so no extra stat per image
+        with os.scandir(image_folder) as entries:
+            image_paths: list[str] = [e.path for e in entries if e.is_file()]
 
         if len(image_paths) == 0:
             print("No image files found")
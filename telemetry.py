@@ -1,7 +1,14 @@
+import functools
 import os
+import select
+import socket
+import struct
+import threading
 import time
-from typing import Optional, List, Tuple
+from queue import Empty, Queue
+from typing import Dict, Optional, List, Tuple
 
+import torch
 from pymavlink import mavutil
 from ultralytics.engine.results import Results  # type: ignore
 
@@ -10,28 +17,67 @@ import util
 # Minimum confidence threshold for object detection
 MIN_CONFIDENCE = 0.5
 
+# Number of object classes reported over telemetry (ids 0..NUM_CLASSES-1)
+NUM_CLASSES = 2
+
 # MAVLink target (UDP out). Default commonly used port is 14550.
 MAVLINK_TARGET_HOST = os.getenv("MAVLINK_TARGET_HOST", "127.0.0.1")
 MAVLINK_TARGET_PORT = int(os.getenv("MAVLINK_TARGET_PORT", "14550"))
 
+# Outgoing frames are coalesced into datagrams of at most TX_MAX_BYTES (fits a
+# 1500-byte MTU), held for no longer than TX_MAX_DELAY seconds
+TX_MAX_BYTES = 1400
+TX_MAX_DELAY = 0.01
+
+# Seconds between attempts to connect() the telemetry socket while its target is unreachable
+CONNECT_RETRY_INTERVAL = 1.0
+
+# Reference for time_boot_ms, taken when this module is loaded
+_BOOT_NS = time.monotonic_ns()
+
 # mavlink_connection: initialized lazily when first send is attempted
 _mavlink_conn: Optional[object] = None
 _mavlink_recv_conn: Optional[object] = None
+# Serializes creating the connections; reads of an existing one take no lock
+_conn_lock = threading.Lock()
 
 
+def _set_sockopts(sock: socket.socket, opts: List[Tuple[int, str, int]]) -> None:
+    """Apply (level, option name, value) socket options best-effort.
+
+    Options missing from this platform's socket module, or refused by the
+    kernel (e.g. SO_BUSY_POLL without CAP_NET_ADMIN), are skipped.
+    """
+    for level, name, value in opts:
+        if not hasattr(socket, name):
+            continue
+        try:
+            sock.setsockopt(level, getattr(socket, name), value)
+        except OSError:
+            pass
+
 def ensure_mavlink() -> Optional[object]:
     """Lazily create and return a pymavlink connection, or None on failure."""
     global _mavlink_conn
-    if _mavlink_conn is not None:
-        return _mavlink_conn
-    try:
-        uri = f"udpout:{MAVLINK_TARGET_HOST}:{MAVLINK_TARGET_PORT}"
-        _mavlink_conn = mavutil.mavlink_connection(uri)
-        return _mavlink_conn
-    except Exception as e:
-        print(f"Failed to open MAVLink connection to {MAVLINK_TARGET_HOST}:{MAVLINK_TARGET_PORT}: {e}")
-        _mavlink_conn = None
-        return None
+    conn = _mavlink_conn
+    if conn is not None:
+        return conn
+    with _conn_lock:
+        if _mavlink_conn is not None:
+            return _mavlink_conn
+        try:
+            uri = f"udpout:{MAVLINK_TARGET_HOST}:{MAVLINK_TARGET_PORT}"
+            conn = mavutil.mavlink_connection(uri)
+            # Room for bursts of coalesced datagrams before sends start failing
+            _set_sockopts(conn.port, [(socket.SOL_SOCKET, "SO_SNDBUF", 1 << 18)])
+        except Exception as e:
+            print(f"Failed to open MAVLink connection to {MAVLINK_TARGET_HOST}:{MAVLINK_TARGET_PORT}: {e}")
+            if conn is not None:
+                conn.close()
+            return None
+        # Publish only once fully set up, since other threads read it without the lock
+        _mavlink_conn = conn
+        return conn
 
 def ensure_mavlink_recv(listen_port: int = 14551) -> Optional[object]:
     """Lazily create and return a pymavlink connection suitable for receiving.
@@ -40,16 +86,46 @@ def ensure_mavlink_recv(listen_port: int = 14551) -> Optional[object]:
     on the given port. The sender should send to this host:port.
     """
     global _mavlink_recv_conn
-    if _mavlink_recv_conn is not None:
-        return _mavlink_recv_conn
-    try:
-        uri = f"udpin:0.0.0.0:{listen_port}"
-        _mavlink_recv_conn = mavutil.mavlink_connection(uri)
-        return _mavlink_recv_conn
-    except Exception as e:
-        print(f"Failed to open MAVLink receive connection on port {listen_port}: {e}")
-        _mavlink_recv_conn = None
-        return None
+    conn = _mavlink_recv_conn
+    if conn is not None:
+        return conn
+    with _conn_lock:
+        if _mavlink_recv_conn is not None:
+            return _mavlink_recv_conn
+        try:
+            uri = f"udpin:0.0.0.0:{listen_port}"
+            conn = mavutil.mavlink_connection(uri)
+            # Busy-poll the NIC for lower wake-up latency, and buffer bursts instead of dropping them
+            _set_sockopts(conn.port, [
+                (socket.SOL_SOCKET, "SO_BUSY_POLL", 50),
+                (socket.SOL_SOCKET, "SO_RCVBUF", 1 << 20),
+                (socket.IPPROTO_UDP, "UDP_GRO", 1),
+            ])
+        except Exception as e:
+            print(f"Failed to open MAVLink receive connection on port {listen_port}: {e}")
+            return None
+        _mavlink_recv_conn = conn
+        return conn
+
+@functools.cache # one tensor per device
+def _class_ids(device: torch.device) -> torch.Tensor:
+    """Return the tensor [0, 1, ..., NUM_CLASSES-1] on `device`."""
+    return torch.arange(NUM_CLASSES, device=device)
+
+def _best_per_class(data: torch.Tensor) -> List[List[float]]:
+    """Return [conf, x1, y1, x2, y2] of the most confident box of each class in `data`.
+
+    `data` is a Boxes data tensor ([x1, y1, x2, y2, (track id,) conf, cls] per row).
+    Classes with no box get a confidence of -inf. The reduction runs on the
+    tensor's device so only NUM_CLASSES rows are copied to the host, in one sync.
+    """
+    confs = data[:, -2]
+    clss = data[:, -1].long()
+    # Column c of `scores` holds each box's confidence if it is class c, else -inf,
+    # so one max over boxes gives every class's best confidence and its index.
+    scores = torch.where(clss.unsqueeze(1) == _class_ids(clss.device), confs.unsqueeze(1), float("-inf"))
+    per_cls, idxs = scores.max(0)
+    return torch.cat((per_cls.unsqueeze(1), data[idxs, :4]), dim=1).float().tolist()
 
 def add_results(results: List[Results], start_time: float) -> None:
     """Select best detection for each class (0 and 1) and send scalar telemetry.
@@ -57,94 +133,230 @@ def add_results(results: List[Results], start_time: float) -> None:
     For each class id in {0,1} we pick the detection with highest confidence
     across the provided Results. For each best detection we compute x/y
     offsets and latency then call send_telemetry_data(x, y, class_id, lat).
+    `start_time` is the time.monotonic() at which the frame was captured.
     """
-    NUM_CLASSES = 2
     best_conf: List[float] = [MIN_CONFIDENCE] * NUM_CLASSES
-    best_info: List[Optional[Tuple[object, int, int]]] = [None] * NUM_CLASSES
+    # (box center x, box center y, frame shape) of the best detection per class
+    best_info: List[Optional[Tuple[float, float, Tuple[int, ...]]]] = [None] * NUM_CLASSES
 
     for result in results:
         boxes = result.boxes
         if not boxes:
             continue
-        # Try to read confidence and class arrays from the Boxes object.
         try:
-            confs = boxes.conf.cpu().numpy()
-            clss = boxes.cls.cpu().numpy().astype(int)
+            best = _best_per_class(boxes.data)
         except Exception:
             # If the Boxes API is different, skip this result.
             continue
 
-        for i, conf in enumerate(confs):
-            cls_id = int(clss[i])
-            if 0 <= cls_id < NUM_CLASSES and float(conf) > best_conf[cls_id]:
-                best_conf[cls_id] = float(conf)
-                best_info[cls_id] = (boxes, int(i), cls_id)
+        for cls_id in range(NUM_CLASSES):
+            conf, x1, y1, x2, y2 = best[cls_id]
+            if conf > best_conf[cls_id]:
+                best_conf[cls_id] = conf
+                best_info[cls_id] = ((x1 + x2) / 2, (y1 + y2) / 2, boxes.orig_shape)
+
+    # One clock read stamps every class sent for this frame
+    now_ns = time.monotonic_ns()
+    time_boot_ms = _time_boot_ms(now_ns)
+    latency = now_ns / 1e9 - start_time
 
     # Send telemetry for each class if we found a detection
-    for i in range(len(best_info)):
-        info = best_info[i]
+    for cls_id in range(len(best_info)):
+        info = best_info[cls_id]
         if info is None:
-            send_telemetry_data(0, 0, i, 0, False)
+            send_telemetry_data(0, 0, cls_id, 0, False, time_boot_ms)
             continue
-        boxes, idx, cls_id = info
-        try:
-            box = boxes[idx]
-        except Exception:
-            box = boxes
+        cx, cy, shape = info
 
-        x = util.get_x_offset_deg(box)
-        y = util.get_y_offset_deg(box)
-        latency = time.time() - start_time
+        x = util.x_offset_deg(cx, shape[1])
+        y = util.y_offset_deg(cy, shape[0])
 
-        send_telemetry_data(x, y, cls_id, latency, True)
+        send_telemetry_data(x, y, cls_id, latency, True, time_boot_ms)
 
 def name_bytes(s: str) -> bytes:
-    b = s.encode("ascii", "ignore")[:10]
-    return b + b"\0" * (10 - len(b))
+    """Encode `s` as a MAVLink 10-byte, NUL-padded name field."""
+    return s.encode("ascii", "ignore")[:10].ljust(10, b"\0")
 
-def send_telemetry_data(x: float, y: float, obj_cls: int, lat: float, detected: bool) -> None:
-    """Send x, y and latency as three separate MAVLink messages.
+# Encoded MAVLink names per class, built once: (vis_x, vis_y, vis_lat, vis_det)
+_NAMES: List[Tuple[bytes, ...]] = [
+    tuple(name_bytes(f"vis_{field}{c}") for field in ("x", "y", "lat", "det")) for c in range(NUM_CLASSES)
+]
 
-    Uses the standard `named_value_float` MAVLink message .
-    Each field is sent in its own message with a short
-    name: 'vis_x', 'vis_y', 'vis_lat', 'vis_det'.
-    """
-    conn = ensure_mavlink()
-    if conn is None:
-        # Connection unavailable — nothing to send.
-        return
+# Telemetry waiting to be sent by _tx_loop, so network I/O never stalls the tracker.
+# Kept short so a stalled sender resumes with fresh values rather than a backlog.
+_tx_q: Queue = Queue(maxsize=8)
+
+def _pack(conn, msg) -> bytes:
+    """Encode `msg` as a MAVLink frame without sending it, keeping `conn`'s sequence numbers in step."""
+    buf = msg.pack(conn.mav)
+    conn.mav.seq = (conn.mav.seq + 1) % 256
+    conn.mav.total_packets_sent += 1
+    conn.mav.total_bytes_sent += len(buf)
+    return buf
+
+# Fields sent per class, in _NAMES order: (message class, payload layout of time_boot_ms + value)
+_FIELDS: Tuple[Tuple[type, str], ...] = (
+    (mavutil.mavlink.MAVLink_named_value_float_message, "<If"),
+    (mavutil.mavlink.MAVLink_named_value_float_message, "<If"),
+    (mavutil.mavlink.MAVLink_named_value_float_message, "<If"),
+    (mavutil.mavlink.MAVLink_named_value_int_message, "<Ii"),
+)
+
+# Encoded frame per (class, field), built once; only time, value, seq and CRC change per send
+_templates: Dict[Tuple[int, int], bytearray] = {}
+
+def _frame(conn, obj_cls: int, field: int, time_boot_ms: int, value) -> bytes:
+    """Encode one telemetry field of `obj_cls` as a MAVLink frame by patching its cached template."""
+    msg_type, layout = _FIELDS[field]
+    if conn.mav.signing.sign_outgoing:
+        # Signed frames carry a per-frame signature; encode them the normal way
+        return _pack(conn, msg_type(time_boot_ms, _NAMES[obj_cls][field], value))
 
-    # time_boot_ms: milliseconds since epoch (wrap to 32-bit)
-    time_boot_ms = int(time.time() * 1000) & 0xFFFFFFFF
+    buf = _templates.get((obj_cls, field))
+    if buf is None:
+        buf = bytearray(msg_type(0, _NAMES[obj_cls][field], 0).pack(conn.mav))
+        _templates[(obj_cls, field)] = buf
 
+    # MAVLink 2 headers are 10 bytes with seq at offset 4, MAVLink 1 headers 6 bytes with seq at 2
+    v2 = buf[0] == mavutil.mavlink.PROTOCOL_MARKER_V2
+    buf[4 if v2 else 2] = conn.mav.seq
+    struct.pack_into(layout, buf, 10 if v2 else 6, time_boot_ms, value)
+    crc = mavutil.mavlink.x25crc(buf[1:-2])
+    crc.accumulate(struct.pack("B", msg_type.crc_extra))
+    struct.pack_into("<H", buf, len(buf) - 2, crc.crc)
+
+    conn.mav.seq = (conn.mav.seq + 1) % 256
+    conn.mav.total_packets_sent += 1
+    conn.mav.total_bytes_sent += len(buf)
+    return bytes(buf)
+
+# Datagrams dropped because the socket's send buffer was full
+tx_dropped = 0
+
+# State of connect() on the telemetry socket; only touched by _tx_loop's thread
+_tx_connected = False
+_tx_connect_warned = False
+_next_connect = 0.0
+
+def _try_connect(conn) -> bool:
+    """Connect `conn`'s socket to its target, retrying at most every CONNECT_RETRY_INTERVAL.
+
+    A connected socket resolves the target and fixes the route once, so each
+    send skips address parsing. Returns whether the socket is connected.
+    """
+    global _tx_connected, _tx_connect_warned, _next_connect
+    if _tx_connected:
+        return True
+    now = time.monotonic()
+    if now < _next_connect:
+        return False
     try:
-        conn.mav.named_value_float_send(time_boot_ms, name_bytes(f"vis_x{obj_cls}"), float(x))
-        conn.mav.named_value_float_send(time_boot_ms, name_bytes(f"vis_y{obj_cls}"), float(y))
-        conn.mav.named_value_float_send(time_boot_ms, name_bytes(f"vis_lat{obj_cls}"), float(lat))
-        conn.mav.named_value_int_send(time_boot_ms, name_bytes(f"vis_det{obj_cls}"), int(detected))
-    except Exception as e:
-        print(f"Failed to send telemetry via named_value_float: {e}")
-        return
+        conn.port.connect(conn.destination_addr)
+    except OSError as e:
+        # The target may not resolve or be routable yet, e.g. before the link is up at boot
+        if not _tx_connect_warned:
+            print(f"Failed to connect to {MAVLINK_TARGET_HOST}:{MAVLINK_TARGET_PORT}, will keep retrying: {e}")
+            _tx_connect_warned = True
+        _next_connect = now + CONNECT_RETRY_INTERVAL
+        return False
+    _tx_connected = True
+    return True
 
-def get_message_text(mg):
+def _send(conn, data: bytes) -> None:
+    """Send one datagram without blocking, dropping it if the kernel buffer is full."""
+    global tx_dropped
     try:
-        if mg is None:
-            return ""
-        # newest.text is typically a bytes/str field depending on pymavlink version
-        text = getattr(mg, "text", None)
-        if text is None:
-            # try other common field names
-            text = getattr(mg, "message", "")
-        # Ensure string
-        if isinstance(text, bytes):
+        if _try_connect(conn):
+            conn.port.send(data, socket.MSG_DONTWAIT)
+        else:
+            conn.port.sendto(data, socket.MSG_DONTWAIT, conn.destination_addr)
+    except BlockingIOError:
+        tx_dropped += 1
+    except OSError:
+        # e.g. ICMP port unreachable while nothing listens; telemetry is best-effort
+        pass
+
+def _tx_loop() -> None:
+    """Send queued telemetry as MAVLink messages; runs forever on a daemon thread.
+
+    Encoded frames are collected into one datagram until it would exceed
+    TX_MAX_BYTES or the oldest frame has waited TX_MAX_DELAY seconds.
+    """
+    pending = bytearray()
+    deadline = 0.0
+    while True:
+        # Only wake up for the flush deadline while frames are pending
+        timeout = max(deadline - time.monotonic(), 0.0) if pending else None
+        try:
+            item = _tx_q.get(timeout=timeout)
+        except Empty:
+            item = None
+
+        conn = ensure_mavlink()
+        if conn is None:
+            # Connection unavailable — nothing to send.
+            pending.clear()
+            continue
+
+        if item is not None:
+            time_boot_ms, obj_cls, x, y, lat, detected = item
             try:
-                return text.decode("utf-8", "ignore")
-            except Exception:
-                return text.decode("ascii", "ignore")
-        return str(text)
-    except Exception as e:
-        print(f"Failed to extract message text: {e}")
+                frames = b"".join(
+                    _frame(conn, obj_cls, field, time_boot_ms, value)
+                    for field, value in enumerate((x, y, lat, detected))
+                )
+            except Exception as e:
+                print(f"Failed to encode telemetry: {e}")
+                frames = b""
+
+            if pending and len(pending) + len(frames) > TX_MAX_BYTES:
+                _send(conn, bytes(pending))
+                pending.clear()
+            if frames and not pending:
+                deadline = time.monotonic() + TX_MAX_DELAY
+            pending += frames
+
+        if pending and (len(pending) >= TX_MAX_BYTES or time.monotonic() >= deadline):
+            _send(conn, bytes(pending))
+            pending.clear()
+
+_tx_thread: threading.Thread = threading.Thread(target=_tx_loop, daemon=True)
+_tx_thread.start()
+
+def _time_boot_ms(now_ns: int) -> int:
+    """Convert a time.monotonic_ns() reading to MAVLink time_boot_ms: ms since startup, wrapped to 32 bits."""
+    return ((now_ns - _BOOT_NS) // 1_000_000) & 0xFFFFFFFF
+
+def send_telemetry_data(x: float, y: float, obj_cls: int, lat: float, detected: bool, time_boot_ms: Optional[int] = None) -> None:
+    """Queue x, y, latency and the detection flag to be sent to the FCU.
+
+    The values are sent from a background thread as standard
+    `named_value_float` / `named_value_int` MAVLink messages, one per field,
+    with a short name: 'vis_x', 'vis_y', 'vis_lat', 'vis_det'.
+    If the sender falls behind, the oldest queued values are dropped rather than blocking.
+    Must only be called from one thread (the tracker), see util.put_latest.
+    `time_boot_ms` defaults to now; callers sending several values can pass one shared stamp.
+    """
+    if time_boot_ms is None:
+        time_boot_ms = _time_boot_ms(time.monotonic_ns())
+
+    util.put_latest(_tx_q, (time_boot_ms, obj_cls, float(x), float(y), float(lat), int(detected)))
+
+def get_message_text(mg) -> str:
+    """Return the text of a STATUSTEXT message, or "" for None.
+
+    pymavlink gives `text` as a str on Python 3 and as bytes on older versions.
+    Errors propagate to the caller, which already handles them for the whole drain.
+    """
+    if mg is None:
         return ""
+    text = mg.text
+    if isinstance(text, (bytes, bytearray)):
+        return text.decode("ascii", "replace")
+    return text
+
+# Priority of FCU commands in get_signal; any other text has priority 0
+SIGNAL_PRIORITY = {"generate": 2, "picture": 1}
 
 def get_signal():
     """Get an input signal from the FCU as a string"""
@@ -155,15 +367,19 @@ def get_signal():
     # Try to read a STATUSTEXT message (standard MAVLink textual message).
     try:
         newest = ""
-        while True:
+        newest_priority = 0
+        # Only call into pymavlink while it has buffered bytes or the socket is
+        # readable, so an idle link costs one select() instead of a failed recvfrom
+        while conn.mav.buf_len() > 0 or select.select([conn.port], [], [], 0)[0]:
             msg = conn.recv_match(type="STATUSTEXT", blocking=False)
             if msg is None:
                 break
             text = get_message_text(msg).strip().lower()
-            # Do not update newest if it is already "generate" and only replace "picture" with "generate"
-            # This finds the most important message and ensures we don't miss one of these
-            if newest != "generate" and (text == "generate" or newest != "picture"):
-                newest = text
+            # Keep the most important message so we don't miss one of these;
+            # among equal priorities the newest wins
+            priority = SIGNAL_PRIORITY.get(text, 0)
+            if priority >= newest_priority:
+                newest, newest_priority = text, priority
     except Exception as e:
         print(f"Failed to read telemetry: {e}")
         return ""
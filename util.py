@@ -1,53 +1,111 @@
 import math
+from queue import Empty, Queue
 
-from ultralytics.engine.results import Boxes # type: ignore
+import cv2
+import torch
+from ultralytics.engine.results import Boxes, Results # type: ignore
 
 # TODO: Change these to the actual camera values
 FOV = [70, 43.75] # Arducam
 # fov = [59.703, 33.583] # Microsoft lifecam or other cameras with diagonal FOV of 68.5 degrees and 1280x720 resolution
 
-def get_x_offset_deg(box: Boxes) -> float:
-    #source: Limelight docs(LINK HERE)
-
-    if len(box[0]):
-        hfov = FOV[0]*(math.pi/180)
-        x1, y1, x2, y2 = box.xyxy[0]
+# Frames are resized to this (width, height) so the whole batch shares one letterbox
+FRAME_SIZE = (640, 480)
 
-        bbox_center_coord = [(x1+x2)/2,(y1+y2)/2]
+def configure_camera(video: cv2.VideoCapture) -> None:
+    """Set a camera to the capture mode the tracker runs on.
 
-        cx = bbox_center_coord[0]
+    Have the camera send MJPG at FRAME_SIZE instead of raw YUYV, and keep only
+    one frame in the driver so reads are never stale.
+    """
+    video.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    video.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_SIZE[0])
+    video.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_SIZE[1])
+    video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
-        nx = (cx-(box.orig_shape[1]/2))/(box.orig_shape[1]/2)
+def x_offset_deg(cx: float, width: float) -> float:
+    """Horizontal angle in degrees from the optical center to pixel column `cx` of a `width`-pixel frame."""
+    #source: Limelight docs(LINK HERE)
+    hfov = FOV[0]*(math.pi/180)
 
-        vw = 2*math.tan((hfov/2))
+    nx = (cx-(width/2))/(width/2)
 
-        vx = vw/2*nx
+    vw = 2*math.tan((hfov/2))
 
-        x_offset_deg = math.atan(vx/1)*(180/math.pi)
+    vx = vw/2*nx
 
-        return float(x_offset_deg)
-    
-    return 0
+    return math.atan(vx/1)*(180/math.pi)
 
-def get_y_offset_deg(box: Boxes) -> float:
+def y_offset_deg(cy: float, height: float) -> float:
+    """Vertical angle in degrees from the optical center to pixel row `cy` of a `height`-pixel frame."""
     #source: Limelight docs(LINK HERE)
+    vfov = FOV[1]*(math.pi/180)
 
-    if len(box[0]):
-        vfov = FOV[1]*(math.pi/180)
-        x1, y1, x2, y2 = box.xyxy[0]
+    ny = (cy-(height/2))/(height/2)
 
-        bbox_center_coord = [(x1+x2)/2,(y1+y2)/2]
+    vh = 2*math.tan((vfov/2))
 
-        cy = bbox_center_coord[1]
+    vy = vh/2*ny
 
-        ny = (cy-(box.orig_shape[0]/2))/(box.orig_shape[0]/2)
+    return math.atan(vy/1)*(180/math.pi)
 
-        vh = 2*math.tan((vfov/2))
+def get_x_offset_deg(box: Boxes) -> float:
+    if len(box[0]):
+        # One host copy of the box instead of a device sync per arithmetic step
+        x1, y1, x2, y2 = box.xyxy[0].tolist()
+        return x_offset_deg((x1+x2)/2, box.orig_shape[1])
 
-        vy = vh/2*ny
+    return 0
 
-        y_offset_deg = math.atan(vy/1)*(180/math.pi)
+def get_y_offset_deg(box: Boxes) -> float:
+    if len(box[0]):
+        x1, y1, x2, y2 = box.xyxy[0].tolist()
+        return y_offset_deg((y1+y2)/2, box.orig_shape[0])
 
-        return float(y_offset_deg)
-    
     return 0
+
+def make_tracker(config: str = "bytetrack.yaml"):
+    """Create an ultralytics object tracker (BYTETracker by default) from a tracker config."""
+    # Imported here like ultralytics does for model.track, so importing util doesn't pull in the trackers' dependencies
+    from ultralytics.trackers.track import TRACKER_MAP # type: ignore
+    from ultralytics.utils import IterableSimpleNamespace # type: ignore
+    from ultralytics.utils.checks import check_yaml # type: ignore
+    try:
+        from ultralytics.utils import YAML # type: ignore
+        load_yaml = YAML.load
+    except ImportError:
+        # Older ultralytics releases only have the function form
+        from ultralytics.utils import yaml_load as load_yaml # type: ignore
+
+    cfg = IterableSimpleNamespace(**load_yaml(check_yaml(config)))
+    return TRACKER_MAP[cfg.tracker_type](args=cfg)
+
+def update_tracker(tracker, result: Results) -> Results:
+    """Track the detections in `result` with `tracker`, as model.track does for one video stream.
+
+    Returns the result narrowed to tracked boxes, with track IDs filled in.
+    """
+    det = result.boxes.cpu().numpy()
+    if len(det) == 0:
+        return result
+    tracks = tracker.update(det, result.orig_img)
+    if len(tracks) == 0:
+        return result
+    # Last column is the index of the detection each track was matched to
+    result = result[tracks[:, -1].astype(int)]
+    result.update(boxes=torch.as_tensor(tracks[:, :-1], device=result.boxes.data.device))
+    return result
+
+def put_latest(q: Queue, item) -> None:
+    """Put `item` on a bounded queue, dropping the oldest entry if the queue is full.
+
+    Only valid when a single thread puts on `q`, so nothing can refill it between
+    the drop and the put. Every producer/consumer queue in this repo is used that way.
+    """
+    if q.full():
+        try:
+            q.get_nowait()
+        except Empty:
+            # The consumer emptied it between full() and get_nowait()
+            pass
+    q.put_nowait(item)